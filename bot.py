@@ -3,17 +3,29 @@ from discord import app_commands
 from discord.ext import commands
 import os
 import asyncio
+import signal
+import ssl
 import aiohttp
+import certifi
 from aiohttp import web
-import json
+import hashlib
+import re
+import io
+import textwrap
+import orjson
 from dotenv import load_dotenv
 import logging
-from typing import Optional
+from typing import Callable, Optional
+from cachetools import TTLCache
 
-load_dotenv()
+# Render and other hosts inject env vars directly; only read .env outside production
+IS_PRODUCTION = os.getenv("ENV") in ("prod", "production")
+if not IS_PRODUCTION:
+    load_dotenv()
 
 # Set up logging (visible in Render logs)
-logging.basicConfig(level=logging.INFO)
+# Production drops to WARNING so per-request INFO logs are skipped entirely
+logging.basicConfig(level=logging.WARNING if IS_PRODUCTION else logging.INFO)
 logger = logging.getLogger(__name__)
 
 intents = discord.Intents.default()
@@ -22,9 +34,25 @@ intents.reactions = True
 
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Shared HTTP session for Grok API calls (created in setup_hook, closed in main)
+bot.http_session: Optional[aiohttp.ClientSession] = None
+bot.batcher_task: Optional[asyncio.Task] = None
+bot.warmup_task: Optional[asyncio.Task] = None
+
+# === DISCORD / WEBSERVER CONFIG ===
+# Read once at import; main() uses these instead of re-querying the environment
+DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+PORT = int(os.getenv("PORT", "8080"))
+
 # === xAI / GROK API CONFIG ===
 # Docs: https://docs.x.ai/docs/guides/chat  :contentReference[oaicite:0]{index=0}
-API_URL = "https://api.x.ai/v1/chat/completions"
+API_BASE_URL = "https://api.x.ai"
+API_PATH = "/v1/chat/completions"  # relative to the shared session's base_url
+
+# One TLS context for the process: the certifi CA bundle is parsed once and shared
+# by every connector. ALPN only offers http/1.1 — aiohttp's client can't speak h2.
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+SSL_CONTEXT.set_alpn_protocols(["http/1.1"])
 
 # NOTE: xAI docs use XAI_API_KEY; you're using GROK_API_KEY env var.
 GROK_API_KEY = os.getenv("GROK_API_KEY")
@@ -50,15 +78,18 @@ VALID_MODELS = [
 if GROK_MODEL not in VALID_MODELS:
     raise ValueError(f"Invalid model '{GROK_MODEL}'. Must be one of: {', '.join(VALID_MODELS)}")
 
+# Slash command sync: set SYNC_COMMANDS=0 to skip it on restarts that don't change
+# commands; set GUILD_ID to sync to one guild instantly (handy for development).
+SYNC_COMMANDS = os.getenv("SYNC_COMMANDS", "1") == "1"
+GUILD_ID = os.getenv("GUILD_ID")
+
 
 # === REAL LIVE SEARCH VIA xAI "search_parameters" (NO FAKE TOOLS) ===
 # Live Search guide: https://docs.x.ai/docs/guides/live-search  :contentReference[oaicite:2]{index=2}
-async def research_query(query: str, message_link: str, model: Optional[str] = None) -> str:
-    logger.info(f"Starting Grok query for: {query[:50]}...")
-
-    active_model = model or GROK_MODEL
 
-    system_prompt = f"""You are a helpful research assistant in a Discord thread.
+# Static parts of every request, built once at import; only the model and
+# messages change per call.
+SYSTEM_PROMPT_TEMPLATE = """You are a helpful research assistant in a Discord thread.
 The user asked: "{query}"
 
 Rules:
@@ -69,88 +100,565 @@ Rules:
 - At the end, say "Replying to: {message_link}"
 - Be concise but thorough."""
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": query},
-    ]
+# Enable xAI Live Search (real web/X/news search)
+# See "search_parameters" docs: mode / max_search_results / return_citations / sources. :contentReference[oaicite:3]{index=3}
+BASE_PAYLOAD = {
+    "model": GROK_MODEL,
+    "temperature": 0.7,
+    "max_tokens": 1000,
+    "search_parameters": {
+        "mode": "on",              # always use live search for this bot path
+        "return_citations": True,  # keep URLs + citations available
+        "max_search_results": 8,   # limit cost a bit
+        # "sources": [              # optional: explicit sources; defaults to web+news+X
+        #     {"type": "web"},
+        #     {"type": "news"},
+        #     {"type": "x"},
+        # ],
+    },
+}
+
+
+# Prompt used when several concurrent queries are coalesced into one API call
+BATCH_SYSTEM_PROMPT_TEMPLATE = """You are a helpful research assistant in a Discord bot.
+You will receive {count} independent questions, labelled Q1..Q{count}.
+
+Rules:
+- Answer each question independently, starting each answer with a line containing only "### Q<n>".
+- Use live web search when you need real-time info (facts, news, prices, events).
+- Always include clickable source links in your answers.
+- Use markdown, bullet points, and code blocks when helpful.
+- Keep each answer under 1000 characters.
+- At the end of each answer, say "Replying to: <link given with that question>"
+- Be concise but thorough."""
+
+_BATCH_HEADER_RE = re.compile(r"^###\s*Q(\d+)\s*$", re.MULTILINE)
+_CHANNEL_SCOPE_RE = re.compile(r"discord(?:app)?\.com/channels/(\d+|@me)/(\d+)")
+
+# Request coalescing: queries arriving within BATCH_WINDOW seconds of each other
+# are answered by a single Grok call (up to MAX_BATCH queries per call). Off unless
+# BATCH_QUERIES=1; even then only one author's queries in one channel share a prompt.
+BATCH_QUERIES = os.getenv("BATCH_QUERIES", "0") == "1"
+BATCH_WINDOW = 0.05
+MAX_BATCH = 4
+_research_queue: asyncio.Queue = asyncio.Queue()
+
+# Cap on concurrent Grok API requests, and how often a 429 is retried
+GROK_SEM = asyncio.Semaphore(int(os.getenv("GROK_CONCURRENCY", "8")))
+GROK_MAX_RETRIES = 3
+# Longest we'll sleep on a 429, whatever Retry-After says; the user is waiting on it
+GROK_MAX_RETRY_DELAY = 10.0
+
+# Minimum seconds between streamed progress updates (each becomes a Discord edit)
+STREAM_PROGRESS_INTERVAL = 0.5
+
+# Finished answers keyed on a hash of the message link and normalized query, so
+# repeat triggers (e.g. several 🤖 reactions on one message) don't re-run the Grok call
+_response_cache: TTLCache = TTLCache(maxsize=1000, ttl=3600)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Futures for queries currently being answered, keyed on (cache key, message link, model),
+# and how many research_query calls are awaiting each one
+_inflight: dict[tuple, asyncio.Future] = {}
+_flight_waiters: dict[tuple, int] = {}
+_background_tasks: set[asyncio.Task] = set()
+
 
-    # Enable xAI Live Search (real web/X/news search)
-    # See "search_parameters" docs: mode / max_search_results / return_citations / sources. :contentReference[oaicite:3]{index=3}
-    payload = {
+def api_error(body, status: int) -> ValueError:
+    """Build (and log) the error for a Grok reply without choices.
+
+    xAI sends either {"error": {"message": ...}} or {"code": ..., "error": "<message>"}.
+    """
+    error = body.get("error") if isinstance(body, dict) else None
+    if isinstance(error, dict):
+        error_msg = error.get("message") or "Unknown API error"
+    else:
+        error_msg = str(error) if error else "Unknown API error"
+    logger.error("API Error details: %s", error_msg)
+    return ValueError(f"Grok API Error: {error_msg} (Status: {status})")
+
+
+async def read_sse_content(response: aiohttp.ClientResponse,
+                           on_progress: Optional[Callable[[str], None]] = None) -> str:
+    """Accumulate streamed `delta.content` pieces from a chat completion SSE body."""
+    parts: list[str] = []
+    last_progress = 0.0
+    loop = asyncio.get_running_loop()
+    async for raw_line in response.content:
+        line = raw_line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+
+        event = orjson.loads(data)
+        if "error" in event:
+            raise api_error(event, response.status)
+        # Keep-alive and usage-only chunks carry no choices; nothing to accumulate
+        if not event.get("choices"):
+            continue
+
+        delta = event["choices"][0].get("delta", {}).get("content")
+        if delta:
+            parts.append(delta)
+            # Throttle progress callbacks; Discord edits are rate limited
+            if on_progress is not None and loop.time() - last_progress >= STREAM_PROGRESS_INTERVAL:
+                last_progress = loop.time()
+                on_progress("".join(parts))
+
+    return "".join(parts) or "No response content."
+
+
+def retry_after_seconds(response: aiohttp.ClientResponse, attempt: int) -> float:
+    """Delay before retrying a 429: the server's Retry-After if given, else exponential,
+    capped at GROK_MAX_RETRY_DELAY."""
+    try:
+        delay = float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        delay = float(2 ** attempt)
+    return min(max(delay, 0.0), GROK_MAX_RETRY_DELAY)
+
+
+async def grok_chat(payload: dict, on_progress: Optional[Callable[[str], None]] = None) -> str:
+    """POST a streaming chat completion to Grok and return the full message content.
+
+    `on_progress`, if given, is called with the text received so far as tokens arrive.
+    """
+    try:
+        for attempt in range(GROK_MAX_RETRIES + 1):
+            retry_delay = None
+            async with GROK_SEM:
+                logger.info("Sending request to Grok API with model: %s", payload["model"])
+                async with bot.http_session.post(API_PATH, json=payload | {"stream": True}) as response:
+                    logger.info("API Response status: %s", response.status)
+                    if response.status == 429 and attempt < GROK_MAX_RETRIES:
+                        retry_delay = retry_after_seconds(response, attempt)
+                    elif response.status == 200 and response.content_type == "text/event-stream":
+                        content = await read_sse_content(response, on_progress)
+                        data = None
+                    elif response.status == 429:
+                        raise ValueError(f"Grok API Error: still rate limited (HTTP 429) "
+                                         f"after {GROK_MAX_RETRIES} retries")
+                    else:
+                        # Errors (and any non-streamed reply) come back as a plain JSON body,
+                        # except from proxies in front of the API (e.g. an HTML 502 page)
+                        try:
+                            data = orjson.loads(await response.read())
+                        except orjson.JSONDecodeError:
+                            logger.error("Non-JSON Grok API response, status %s", response.status)
+                            raise ValueError(f"Grok API Error: HTTP {response.status} "
+                                             f"{response.reason or ''} (non-JSON response)")
+                    # Hand the connection back to the pool now rather than at GC time
+                    await response.release()
+
+            if retry_delay is None:
+                break
+            # Back off outside the semaphore so other queries can use the slot
+            logger.warning("Grok API rate limited (429), retrying in %.1fs", retry_delay)
+            await asyncio.sleep(retry_delay)
+
+        if data is not None:
+            if not isinstance(data, dict) or not data.get("choices"):
+                raise api_error(data, response.status)
+
+            choice = data["choices"][0]["message"]
+            content = choice.get("content", "No response content.")
+
+        logger.info("Grok query successful: %d chars", len(content))
+        return content
+
+    except asyncio.TimeoutError:
+        logger.error("API call timed out after 60s")
+        raise ValueError("Grok API timed out (slow service—try again later)")
+    except aiohttp.ClientError as e:
+        logger.error("Network error: %s", e)
+        raise ValueError(f"Network issue with Grok API: {e}")
+    except Exception as e:
+        logger.error("Unexpected error in grok_chat: %s", e)
+        raise ValueError(f"Unexpected Grok error: {e}")
+
+
+async def single_query(query: str, message_link: str, model: Optional[str] = None,
+                       on_progress: Optional[Callable[[str], None]] = None) -> str:
+    active_model = model or GROK_MODEL
+
+    system_prompt = SYSTEM_PROMPT_TEMPLATE.format(query=query, message_link=message_link)
+    payload = BASE_PAYLOAD | {
         "model": active_model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": query},
+        ],
+    }
+    return await grok_chat(payload, on_progress)
+
+
+def query_cache_key(query: str, message_link: str) -> str:
+    # The answer quotes message_link ("Replying to: ..."), so it's part of the key:
+    # the same text asked elsewhere must not get (or leak) another message's link
+    # Case and whitespace differences in the query itself shouldn't miss the cache;
+    # the link is used verbatim
+    normalized_query = _WHITESPACE_RE.sub(" ", query.lower()).strip()
+    return hashlib.blake2b(f"{message_link}\n{normalized_query}".encode(), digest_size=16).hexdigest()
+
+
+def spawn(coro) -> asyncio.Task:
+    """create_task that keeps a strong reference until the task finishes."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def resolve_future(fut: asyncio.Future, coro):
+    """Await `coro` and hand its result (or exception) to `fut`."""
+    try:
+        result = await coro
+    except Exception as e:
+        if not fut.done():
+            fut.set_exception(e)
+    else:
+        if not fut.done():
+            fut.set_result(result)
+
+
+def resolve_in_background(fut: asyncio.Future, coro) -> asyncio.Task:
+    """spawn(resolve_future(fut, coro)), cancelled again if `fut` is cancelled first."""
+    task = spawn(resolve_future(fut, coro))
+    fut.add_done_callback(lambda f: task.cancel() if f.cancelled() else None)
+    return task
+
+
+def finish_flight(flight_key: tuple, cache_key: str, fut: asyncio.Future):
+    # A cancelled flight may already have been replaced by a newer one
+    if _inflight.get(flight_key) is fut:
+        del _inflight[flight_key]
+    if not fut.cancelled() and fut.exception() is None:
+        _response_cache[cache_key] = fut.result()
+
+
+async def research_query(query: str, message_link: str, model: Optional[str] = None,
+                         on_progress: Optional[Callable[[str], None]] = None,
+                         author_id: Optional[int] = None) -> str:
+    """Answer `query` via Grok, using the cache, in-flight dedupe and batching.
+
+    `on_progress` receives partial text while the answer streams in; it is only
+    called when this call owns a solo request (not on cache hits, joined flights
+    or multi-query batches). `author_id` is who asked, used to scope batching.
+    """
+    logger.info("Starting Grok query for: %.50s...", query)
+
+    key = query_cache_key(query, message_link)
+    cached = _response_cache.get(key)
+    if cached is not None:
+        logger.info("Grok response cache hit")
+        return cached
+
+    # Single-flight: duplicate concurrent queries await the first caller's future
+    # instead of issuing their own API call. Only callers for the same message
+    # link may share a flight, since the answer names that link.
+    flight_key = (key, message_link, model or GROK_MODEL)
+    fut = _inflight.get(flight_key)
+    if fut is None or fut.done():
+        fut = asyncio.get_running_loop().create_future()
+        _inflight[flight_key] = fut
+        fut.add_done_callback(lambda f: finish_flight(flight_key, key, f))
+
+        # Explicit (fallback) models bypass the batcher and go straight to the API
+        if BATCH_QUERIES and (model is None or model == GROK_MODEL):
+            scope = batch_scope(message_link, author_id)
+            await _research_queue.put((scope, (query, message_link, fut, on_progress)))
+        else:
+            resolve_in_background(fut, single_query(query, message_link, model, on_progress))
+    else:
+        logger.info("Joining in-flight Grok query")
+
+    # Shield so one caller giving up doesn't cancel the answer for everyone else;
+    # once the last caller gives up, cancel the flight so no Grok call is spent on it
+    _flight_waiters[flight_key] = _flight_waiters.get(flight_key, 0) + 1
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        if _flight_waiters[flight_key] == 1 and _inflight.get(flight_key) is fut:
+            fut.cancel()
+        raise
+    finally:
+        _flight_waiters[flight_key] -= 1
+        if not _flight_waiters[flight_key]:
+            del _flight_waiters[flight_key]
+
+
+async def run_batch(batch: list):
+    """Answer a batch of (query, link, future, on_progress) items and resolve each future."""
+    # Skip queries whose callers all gave up while they sat in the queue
+    batch = [item for item in batch if not item[2].done()]
+    if not batch:
+        return
+    if len(batch) == 1:
+        query, message_link, fut, on_progress = batch[0]
+        resolve_in_background(fut, single_query(query, message_link, on_progress=on_progress))
+        return
+
+    logger.info("Batching %d Grok queries into one request", len(batch))
+    messages = [{"role": "system", "content": BATCH_SYSTEM_PROMPT_TEMPLATE.format(count=len(batch))}]
+    for n, (query, message_link, _, _) in enumerate(batch, start=1):
+        messages.append({"role": "user", "content": f"Q{n} (link: {message_link}): {query}"})
+    payload = BASE_PAYLOAD | {
         "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 1000,
-        "search_parameters": {
-            "mode": "on",              # always use live search for this bot path
-            "return_citations": True,  # keep URLs + citations available
-            "max_search_results": 8,   # limit cost a bit
-            # "sources": [              # optional: explicit sources; defaults to web+news+X
-            #     {"type": "web"},
-            #     {"type": "news"},
-            #     {"type": "x"},
-            # ],
-        },
+        "max_tokens": BASE_PAYLOAD["max_tokens"] * len(batch),
     }
 
-    timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        try:
-            logger.info(f"Sending request to Grok API with model: {active_model}")
-            response = await session.post(API_URL, json=payload, headers=headers)
-            logger.info(f"API Response status: {response.status}")
+    try:
+        content = await grok_chat(payload)
+    except Exception as e:
+        for _, _, fut, _ in batch:
+            if not fut.done():
+                fut.set_exception(e)
+        return
 
-            data = await response.json()
+    # re.split with one group yields [preamble, n1, answer1, n2, answer2, ...]
+    pieces = _BATCH_HEADER_RE.split(content)
+    answers = {int(n): text.strip() for n, text in zip(pieces[1::2], pieces[2::2])}
 
-            if "choices" not in data or not data["choices"]:
-                error_msg = data.get("error", {}).get("message", "Unknown API error")
-                logger.error(f"API Error details: {error_msg}")
-                raise ValueError(f"Grok API Error: {error_msg} (Status: {response.status})")
+    retries = []
+    for n, (query, message_link, fut, on_progress) in enumerate(batch, start=1):
+        if fut.done():
+            continue
+        if answers.get(n):
+            fut.set_result(answers[n])
+            continue
+        # The model skipped or mangled this section — answer it on its own
+        logger.warning("Batch answer for Q%d missing, retrying individually", n)
+        retries.append(resolve_future(fut, single_query(query, message_link, on_progress=on_progress)))
+    await asyncio.gather(*retries)
 
-            choice = data["choices"][0]["message"]
-            content = choice.get("content", "No response content.")
-            logger.info(f"Grok query successful: {len(content)} chars")
-            return content
-
-        except asyncio.TimeoutError:
-            logger.error("API call timed out after 60s")
-            raise ValueError("Grok API timed out (slow service—try again later)")
-        except aiohttp.ClientError as e:
-            logger.error(f"Network error: {e}")
-            raise ValueError(f"Network issue with Grok API: {e}")
+
+def batch_scope(message_link: str, author_id: Optional[int]):
+    """Queries may only share a batch with others by the same author in the same channel.
+
+    Anything without a known author or a recognisable channel link gets a scope of its own.
+    """
+    m = _CHANNEL_SCOPE_RE.search(message_link)
+    return (m[1], m[2], author_id) if m and author_id is not None else object()
+
+
+async def research_batcher():
+    """Drain the research queue, grouping one author's queries that arrive close together."""
+    while True:
+        batch = [await _research_queue.get()]
+        # Nothing else waiting: send right away rather than holding a solo query
+        # for the batch window
+        if not _research_queue.empty():
+            await asyncio.sleep(BATCH_WINDOW)
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(_research_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+        # Never mix different users' queries into one prompt: one user's text
+        # could steer the answer posted in someone else's thread
+        groups: dict = {}
+        for scope, item in batch:
+            groups.setdefault(scope, []).append(item)
+        for group in groups.values():
+            spawn(run_batch(group))
+
+
+def make_resolver() -> Optional[aiohttp.AsyncResolver]:
+    """Fully async DNS via aiodns when installed (aiohttp[speedups]), else aiohttp's default."""
+    try:
+        return aiohttp.AsyncResolver()
+    except RuntimeError:
+        logger.info("aiodns not installed, using threaded DNS resolver")
+        return None
+
+
+async def warm_up_grok_connection():
+    """Fill the DNS cache and open a keep-alive TLS connection before the first real query."""
+    try:
+        async with bot.http_session.get(API_PATH, allow_redirects=False) as response:
+            await response.read()
+        logger.info("Grok API connection warmed up")
+    except Exception as e:
+        logger.warning("Grok API warm-up failed (ignored): %s", e)
+
+
+@bot.event
+async def setup_hook():
+    # One long-lived session so Grok calls reuse pooled keep-alive connections
+    # instead of paying a fresh DNS + TCP + TLS handshake per request.
+    bot.http_session = aiohttp.ClientSession(
+        base_url=API_BASE_URL,
+        timeout=aiohttp.ClientTimeout(total=60),
+        connector=aiohttp.TCPConnector(
+            limit=128,
+            limit_per_host=64,
+            use_dns_cache=True,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+            keepalive_timeout=90,
+            ssl=SSL_CONTEXT,
+            resolver=make_resolver(),
+        ),
+        cookie_jar=aiohttp.DummyCookieJar(),
+        headers=headers,
+        json_serialize=lambda obj: orjson.dumps(obj).decode(),
+    )
+    logger.info("HTTP session for Grok API created")
+
+    if BATCH_QUERIES:
+        bot.batcher_task = asyncio.create_task(research_batcher())
+    bot.warmup_task = asyncio.create_task(warm_up_grok_connection())
+
+    # setup_hook runs once per process, unlike on_ready which fires again on
+    # every gateway reconnect — so slash commands are synced at most once here.
+    if SYNC_COMMANDS:
+        try:
+            if GUILD_ID:
+                guild = discord.Object(id=int(GUILD_ID))
+                bot.tree.copy_global_to(guild=guild)
+                synced = await bot.tree.sync(guild=guild)
+            else:
+                synced = await bot.tree.sync()
+            logger.info("Synced %d slash commands", len(synced))
         except Exception as e:
-            logger.error(f"Unexpected error in research_query: {e}")
-            raise ValueError(f"Unexpected Grok error: {e}")
+            logger.error("Slash sync error: %s", e)
 
 
 @bot.event
 async def on_ready():
-    logger.info(f"{bot.user} is online! Using model: {GROK_MODEL}")
-    try:
-        synced = await bot.tree.sync()
-        logger.info(f"Synced {len(synced)} slash commands")
-    except Exception as e:
-        logger.error(f"Slash sync error: {e}")
+    logger.info("%s is online! Using model: %s", bot.user, GROK_MODEL)
+    invalidate_status()
+
+
+@bot.event
+async def on_disconnect():
+    invalidate_status()
+
+
+# Split long text into Discord-sized chunks, snapping each cut back to the last
+# newline (or space) within `window` chars to avoid cutting mid-line or mid-word.
+# A ``` block that spans a cut is still split across messages.
+# Yields (start, end) offsets so callers slice each chunk only once, when sending.
+def chunk_bounds(text: str, limit: int = 1900, window: int = 200):
+    start, n = 0, len(text)
+    while n - start > limit:
+        end = start + limit
+        cut = text.rfind("\n", end - window, end)
+        if cut == -1:
+            cut = text.rfind(" ", end - window, end)
+        if cut == -1:
+            yield start, end
+            start = end
+        else:
+            yield start, cut
+            start = cut + 1
+    yield start, n
+
+
+CONTINUED_SUFFIX = "\n\n...(continued)"
+CHUNK_PREFIX_RESERVE = 16  # room for the "**(i/n)**" line and its newline
+
+
+# Post an answer + footer to a thread or interaction followup, staying under
+# Discord's 2000 char limit. `replace` is an existing message (e.g. a streaming
+# preview) to edit into the final answer, or to remove if the answer needs more room.
+async def send_chunked(dst, answer: str, footer: str, *, limit: int = 2000, chunk: int = 1900,
+                       file_threshold: int = 4000, replace: Optional[discord.Message] = None):
+    # Very long answers go out whole as one markdown attachment: a single request
+    # instead of several chunked sends
+    if len(answer) + len(footer) > file_threshold:
+        if replace is not None:
+            await replace.delete()
+        reply = discord.File(io.BytesIO(answer.encode()), filename="reply.md")
+        await dst.send(footer.strip(), file=reply)
+        return
+
+    # Common case: everything fits in one message, assembled with a single join
+    if len(answer) + len(footer) <= limit:
+        content = "".join((answer, footer))
+        if replace is not None:
+            await replace.edit(content=content)
+        else:
+            await dst.send(content)
+        return
+
+    if replace is not None:
+        await replace.delete()
+
+    # Leave room for the "(i/n)" prefix and the longest suffix a chunk can carry
+    chunk = min(chunk, limit - max(len(footer), len(CONTINUED_SUFFIX)) - CHUNK_PREFIX_RESERVE)
+    bounds = list(chunk_bounds(answer, chunk))
+    total = len(bounds)
+    # Send all chunks concurrently; the (i/n) prefix keeps them readable
+    # even if Discord delivers them out of order.
+    await asyncio.gather(*(
+        dst.send(f"**({i}/{total})**\n{answer[start:end]}{footer if i == total else CONTINUED_SUFFIX}")
+        for i, (start, end) in enumerate(bounds, start=1)
+    ))
+
+
+# Live preview for a streaming answer: the first update posts a message and later
+# ones edit it. `dst` may also be a task resolving to the destination (e.g. a thread
+# still being created). Returns (on_progress callback, coroutine fn giving the preview message).
+def make_stream_preview(dst, limit: int = 1900):
+    state = {"message": None, "task": None}
+
+    async def update(text: str):
+        preview = text[:limit] + " ▌"
+        try:
+            if state["message"] is None:
+                target = await dst if isinstance(dst, asyncio.Future) else dst
+                state["message"] = await target.send(preview)
+            else:
+                await state["message"].edit(content=preview)
+        except discord.HTTPException as e:
+            logger.warning("Stream preview update failed: %s", e)
+
+    def on_progress(text: str):
+        # Drop this update if the previous send/edit is still in flight
+        if state["task"] is None or state["task"].done():
+            state["task"] = spawn(update(text))
+
+    async def finish() -> Optional[discord.Message]:
+        if state["task"] is not None:
+            await state["task"]
+        return state["message"]
+
+    return on_progress, finish
 
 
 # Simple helper to parse a Discord message URL into (guild_id, channel_id, message_id)
+_MSG_LINK_RE = re.compile(
+    r"(?<![\w.-])(?:https?://)?(?:ptb\.|canary\.)?discord(?:app)?\.com/channels/(\d+)/(\d+)/(\d+)(?!\w)"
+)
+
+
 def parse_message_link(link: str):
     """
     Accepts URLs like:
     https://discord.com/channels/<guild_id>/<channel_id>/<message_id>
+    (also ptb./canary. subdomains and discordapp.com), including when wrapped
+    in <...> or surrounded by other text
     """
-    try:
-        if "discord.com/channels/" not in link:
-            return None
-        parts = link.strip().split("discord.com/channels/")[1].split("/")
-        if len(parts) < 3:
-            return None
-        guild_id = int(parts[0])
-        channel_id = int(parts[1])
-        message_id = int(parts[2])
-        return guild_id, channel_id, message_id
-    except Exception:
-        return None
+    m = _MSG_LINK_RE.search(link)
+    return (int(m[1]), int(m[2]), int(m[3])) if m else None
+
+
+async def get_message(channel, message_id: int) -> discord.Message:
+    """Resolve a message from discord.py's cache first, falling back to a REST fetch.
+
+    Only discord.py's own cache is consulted: it applies edits as they arrive, so
+    re-reacting to an edited message researches the current text. A cached message
+    only counts if it is in `channel`, like fetch_message would require.
+    """
+    message = discord.utils.find(
+        lambda m: m.id == message_id and m.channel.id == channel.id, bot.cached_messages
+    )
+    if message is None:
+        message = await channel.fetch_message(message_id)
+    return message
 
 
 # Slash command: can accept either a message URL or free-form query text
@@ -158,7 +666,7 @@ def parse_message_link(link: str):
 @app_commands.describe(message="The message URL or text you want researched")
 async def research_slash(interaction: discord.Interaction, message: str):
     await interaction.response.defer()
-    logger.info(f"/research triggered with: {message[:80]}...")
+    logger.info("/research triggered with: %.80s...", message)
 
     # Try to treat input as a Discord message URL
     parsed = parse_message_link(message)
@@ -170,131 +678,191 @@ async def research_slash(interaction: discord.Interaction, message: str):
             return
 
         try:
-            target_message = await channel.fetch_message(message_id)
+            target_message = await get_message(channel, message_id)
         except Exception as e:
-            logger.error(f"Failed to fetch message from link: {e}")
+            logger.error("Failed to fetch message from link: %s", e)
             await interaction.followup.send("Could not fetch that message from the link.", ephemeral=True)
             return
 
         # Reuse the same thread-based flow as the 🤖 reaction
-        await do_research(target_message)
+        skip_reason = await do_research(target_message)
+        if skip_reason is not None:
+            await interaction.followup.send(skip_reason, ephemeral=True)
+            return
         await interaction.followup.send("Started research thread for that message.", ephemeral=True)
         return
 
     # Otherwise treat the input as a plain research question in the current channel
     try:
         original_link = interaction.channel.jump_url if interaction.channel else "Direct /research invocation"
-        answer = await research_query(message, original_link)
-
-        # Truncate to avoid Discord 2000 char limit
-        max_content_length = 1800
-        if len(answer) > max_content_length:
-            answer = answer[:max_content_length] + "\n... (truncated)"
-
-        footer = f"\n\nReplying to → {original_link}"
-        final_answer = answer + footer
-
-        if len(final_answer) > 2000:
-            chunk_size = 1900
-            answer_parts = [answer[i:i + chunk_size] for i in range(0, len(answer), chunk_size)]
-            for i, part in enumerate(answer_parts):
-                if i == len(answer_parts) - 1:
-                    await interaction.followup.send(part + footer)
-                else:
-                    await interaction.followup.send(part + "\n\n...(continued)")
-        else:
-            await interaction.followup.send(final_answer)
+        answer = await research_query(message, original_link, author_id=interaction.user.id)
+
+        await send_chunked(interaction.followup, answer, f"\n\nReplying to → {original_link}")
 
     except Exception as e:
-        logger.error(f"/research error: {e}")
+        logger.error("/research error: %s", e)
         await interaction.followup.send(f"❌ Error: {e}", ephemeral=True)
 
 
+# Cap on research jobs running at once (each holds a Grok call); extra jobs wait in FIFO order
+MAX_CONCURRENT_RESEARCH = int(os.getenv("MAX_CONCURRENT_RESEARCH", "4"))
+research_sem = asyncio.Semaphore(MAX_CONCURRENT_RESEARCH)
+_research_waiting = 0
+
+
 # Reaction trigger: 🤖 on a message starts a research thread
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
-    if str(payload.emoji) != "🤖":
-        return
+    # Cheapest checks first: an int compare, then a plain attribute compare
+    # (str(payload.emoji) would format a new string for every reaction in the guild)
     if payload.user_id == bot.user.id:
         return
+    if payload.emoji.name != "🤖":
+        return
+    # do_research ignores the bot's own messages, so don't fetch them at all
+    if payload.message_author_id == bot.user.id:
+        return
 
+    # get_channel is an in-memory lookup; only uncached channels cost a REST call
     channel = bot.get_channel(payload.channel_id)
     if channel is None:
-        return
-
-    message = await channel.fetch_message(payload.message_id)
-    logger.info(f"🤖 Reaction on message: {message.content[:80]}...")
+        try:
+            channel = await bot.fetch_channel(payload.channel_id)
+        except discord.HTTPException as e:
+            logger.error("Failed to fetch channel %s: %s", payload.channel_id, e)
+            return
+    message = await get_message(channel, payload.message_id)
+    logger.info("🤖 Reaction on message: %.80s...", message.content)
     await do_research(message)
 
 
-async def do_research(message: discord.Message):
-    if message.author == bot.user:
-        return
-
-    original_link = message.jump_url
+def message_preview(content: str, width: int = 50) -> str:
+    """Short single-line preview of a message, cut on a word boundary."""
+    preview = textwrap.shorten(content, width=width, placeholder="...")
+    # shorten() returns just the placeholder when the first word alone is too long
+    return preview if preview != "..." else content[:width - 3] + "..."
 
-    thread = await message.create_thread(
-        name=f"Research: {message.content[:50]}...",
-        auto_archive_duration=1440,
-    )
 
-    await thread.send("🔍 Researching with Grok (live web search enabled)...")
-    logger.info(f"Thread created for message: {message.id}")
+async def research_answer(message: discord.Message, original_link: str,
+                          thread_task: asyncio.Task, on_progress: Callable[[str], None]) -> str:
+    """Run the Grok query for `message` while its thread is still being created."""
+    # Bound concurrent research jobs; let users know when they're waiting
+    global _research_waiting
+    if research_sem.locked():
+        _research_waiting += 1
+        try:
+            thread = await thread_task
+            await thread.send(f"⏳ Queued (position {_research_waiting}) — waiting for a free research slot...")
+            await research_sem.acquire()
+        finally:
+            _research_waiting -= 1
+    else:
+        await research_sem.acquire()
 
     try:
         # Try main model, fallback if fails for model-related reasons
         try:
-            answer = await research_query(message.content, original_link)
+            return await research_query(message.content, original_link, on_progress=on_progress,
+                                        author_id=message.author.id)
         except ValueError as e:
             if "Invalid model" in str(e) or "Grok API Error" in str(e):
-                logger.warning(f"Main model failed ({e}), trying fallback: {FALLBACK_MODEL}")
-                answer = await research_query(message.content, original_link, model=FALLBACK_MODEL)
-            else:
-                raise
-
-        # Truncate if too long to avoid hitting Discord's 2000 char limit
-        max_content_length = 1800  # Leave buffer for footer
-        if len(answer) > max_content_length:
-            answer = answer[:max_content_length] + "\n... (truncated)"
-
-        footer = f"\n\nReplying to → {original_link}"
-        final_answer = answer + footer
-
-        # Split into Discord-safe chunks (2000 char limit)
-        if len(final_answer) > 2000:
-            chunk_size = 1900
-            answer_parts = [answer[i:i + chunk_size] for i in range(0, len(answer), chunk_size)]
-            for i, part in enumerate(answer_parts):
-                if i == len(answer_parts) - 1:
-                    await thread.send(part + footer)
-                else:
-                    await thread.send(part + "\n\n...(continued)")
-        else:
-            await thread.send(final_answer)
+                logger.warning("Main model failed (%s), trying fallback: %s", e, FALLBACK_MODEL)
+                return await research_query(message.content, original_link, model=FALLBACK_MODEL,
+                                            on_progress=on_progress, author_id=message.author.id)
+            raise
+    finally:
+        research_sem.release()
+
+
+async def do_research(message: discord.Message) -> Optional[str]:
+    """Research `message` in a new thread. Returns why it was skipped, or None if it ran."""
+    if message.author == bot.user:
+        return "I can't research my own messages."
+
+    # Image-only, sticker or near-empty messages: nothing to research, so skip
+    # the thread and the Grok call entirely
+    if len(message.content.strip()) < 3:
+        try:
+            await message.add_reaction("❌")
+        except discord.HTTPException as e:
+            logger.warning("Could not react to skipped message %s: %s", message.id, e)
+        return "That message has no text to research."
+
+    original_link = message.jump_url
+    preview = message_preview(message.content)
+
+    # Thread creation and the Grok call are independent I/O, so run them side by
+    # side; the thread-create round-trip hides behind the much slower LLM call.
+    # No "Researching..." placeholder: the thread name already says what's happening
+    thread_task = asyncio.create_task(message.create_thread(
+        name=f"Research: {preview}",
+        auto_archive_duration=1440,
+    ))
+    # Show the answer as it streams in, then edit that message into the final reply
+    on_progress, finish_preview = make_stream_preview(thread_task)
+    answer_task = asyncio.create_task(research_answer(message, original_link, thread_task, on_progress))
+
+    try:
+        thread = await thread_task
+    except Exception:
+        # Nowhere to post the answer. Cancelling drops the Grok call unless another
+        # caller is waiting on the same query (then it still runs for them)
+        answer_task.cancel()
+        raise
+    logger.info("Thread created for message %s: %s", message.id, preview)
+
+    try:
+        answer = await answer_task
 
-        await thread.send("✅ Grok research complete!")
+        # The completion note rides along with the last chunk instead of its own message
+        await send_chunked(thread, answer, f"\n\nReplying to → {original_link}\n\n✅ Grok research complete!",
+                           replace=await finish_preview())
         logger.info("Research complete and posted")
 
     except Exception as e:
+        # Don't leave a half-streamed answer (with its "▌" cursor) above the error
+        stream_message = await finish_preview()
+        if stream_message is not None:
+            try:
+                await stream_message.delete()
+            except discord.HTTPException:
+                pass  # already gone, e.g. send_chunked removed it before failing
         error_msg = f"❌ Error: {str(e)} (Check bot logs for details)"
         await thread.send(error_msg)
-        logger.error(f"do_research error for message {message.id}: {e}")
+        logger.error("do_research error for message %s: %s", message.id, e)
+
+    return None
 
 
 # Webserver & main (health checks, status)
+_OK_BODY = b"OK"
+
+# Serialized /status body; only changes when the bot connects or disconnects,
+# so it's rebuilt lazily after invalidate_status() rather than per probe
+_status_body: Optional[bytes] = None
+
+
+def invalidate_status():
+    global _status_body
+    _status_body = None
+
+
 async def start_webserver(port: int = 8080):
     """Start a simple aiohttp web server for health checks and status."""
     app = web.Application()
 
     async def health(request):
-        return web.Response(text="OK")
+        return web.Response(body=_OK_BODY, content_type="text/plain")
 
     async def status(request):
-        return web.json_response({
-            "bot": str(bot.user) if bot.user else None,
-            "ready": bot.is_ready(),
-            "model": GROK_MODEL,
-        })
+        global _status_body
+        if _status_body is None:
+            _status_body = orjson.dumps({
+                "bot": str(bot.user) if bot.user else None,
+                "ready": bot.is_ready(),
+                "model": GROK_MODEL,
+            })
+        return web.Response(body=_status_body, content_type="application/json")
 
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
@@ -304,31 +872,64 @@ async def start_webserver(port: int = 8080):
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
-    logger.info(f"Webserver started on 0.0.0.0:{port}")
+    logger.info("Webserver started on 0.0.0.0:%d", port)
     return runner
 
 
 async def main():
     """Orchestrator: start webserver and discord bot concurrently."""
-    port = int(os.getenv("PORT", "8080"))
+    # Stop cleanly on SIGTERM (Render redeploys) and SIGINT (Ctrl+C)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # not supported on Windows event loops
 
     # Start webserver
-    web_runner = await start_webserver(port)
-
-    # Start bot
-    token = os.getenv("DISCORD_TOKEN")
-    if not token:
-        logger.warning("DISCORD_TOKEN is not set — starting only the webserver. The bot will not run.")
-        await asyncio.Event().wait()
-
-    bot_task = asyncio.create_task(bot.start(token))
+    web_runner = await start_webserver(PORT)
 
+    bot_started = False
     try:
-        await bot_task
+        # Start bot
+        if not DISCORD_TOKEN:
+            logger.warning("DISCORD_TOKEN is not set — starting only the webserver. The bot will not run.")
+            await stop_event.wait()
+            return
+
+        async def run_bot():
+            await bot.start(DISCORD_TOKEN)
+            stop_event.set()  # bot closed on its own: let the watcher finish too
+
+        async def close_on_stop():
+            await stop_event.wait()
+            logger.info("Shutdown signal received, stopping bot")
+            await bot.close()
+
+        # If either task fails the TaskGroup cancels the other, so a crashed
+        # gateway connection can't leave the process hanging (or vice versa)
+        bot_started = True
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(run_bot())
+            tg.create_task(close_on_stop())
     finally:
-        await bot.close()
+        for task in (bot.batcher_task, bot.warmup_task):
+            if task is not None:
+                task.cancel()
+        if bot_started:
+            await bot.close()
+        if bot.http_session is not None:
+            await bot.http_session.close()
         await web_runner.cleanup()
 
 
 if __name__ == "__main__":
+    # uvloop (libuv) has much lower per-callback overhead than the default loop;
+    # optional since it isn't available on Windows
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio event loop")
     asyncio.run(main())